@@ -2,12 +2,16 @@ import flask
 from flask import request, jsonify
 
 import psycopg2 # connect (to Postgres database)
+from psycopg2.pool import ThreadedConnectionPool, PoolError # (per-replica connection pools)
 
 from pkg_resources import resource_string # (for retrieving sql queries)
 import configparser # (to read properties file)
 
 from collections import defaultdict
 from datetime import datetime # (for validating user input)
+import itertools # (round-robin over read replicas)
+import threading # (guard replica state across request threads)
+import time # (for spacing out replica health checks)
 
 
 app = flask.Flask(__name__)
@@ -21,6 +25,16 @@ cache_direct_subslugs = defaultdict(list) # KEY: slug, VALUE: direct subslugs
 cache_port_codes = defaultdict(list) # KEY: slug, VALUE: direct port codes
 # E.g., stockholm_area:['SENRK', 'SESOE', 'SEGVX', 'SEOXE', 'SESTO']
 
+replicas = {} # KEY: replica section name, VALUE: pools and health state
+# E.g., replica_1:{'pool': <ThreadedConnectionPool>, 'check_conn': <connection>,
+#                  'healthy': True, 'lag': 0.4, 'checked_at': 1634600000.0}
+replicas_loaded = False # True once [replicas] has been read
+replica_config = None # properties file as read by load_replicas()
+replica_settings = {} # parsed [replicas] settings, see read_replica_settings()
+
+replica_lock = threading.Lock()
+replica_counter = itertools.count() # next replica to try (round-robin)
+
 
 @app.before_first_request
 def update_cache_direct_subslugs():
@@ -32,12 +46,8 @@ def update_cache_direct_subslugs():
     """
     query = 'SELECT slug, parent_slug FROM regions'
 
-    conn = connect_database()
-    cursor = conn.cursor()
-    cursor.execute(query)
-    result = cursor.fetchall()
-    cursor.close() # Close database connection
-    
+    result = execute_read_query(query)
+
     for slug, parent_slug in result:
         cache_direct_subslugs[parent_slug].append(slug)
 
@@ -51,12 +61,8 @@ def update_cache_port_codes():
     """
     query = 'SELECT parent_slug, code FROM ports'
 
-    conn = connect_database()
-    cursor = conn.cursor()
-    cursor.execute(query)
-    result = cursor.fetchall()
-    cursor.close() # Close database connection
-    
+    result = execute_read_query(query)
+
     for parent_slug, code in result:
         cache_port_codes[parent_slug].append(code)
 
@@ -67,30 +73,15 @@ def average():
     
     If the average is comprised of fewer than 3 days, return null for that day.
     """
-    args = request.args # ensure required arguments are passed
+    args = parse_average_args(request.args)
 
-    origin = args.get('origin')
-    destination = args.get('destination')
-    date_from = args.get('date_from')
-    date_to = args.get('date_to')
-    
-    if is_null_or_empty(origin, destination, date_from, date_to):
-        return jsonify( {'error': 'Required parameter is missing or empty'} ), 400
-
-    elif not is_valid_date(date_from) or not is_valid_date(date_to):
-        return jsonify( {'error': 'Improper date format provided, use YYYY-MM-DD'} ), 400
-
-    elif not is_valid_code_or_slug(origin) or not is_valid_code_or_slug(destination):
-        return jsonify( {'error': 'Non-existent code or slug provided'} ) # still valid input
+    if 'error' in args:
+        return args['error']
 
     else:
-        query_and_params = average_query(origin, destination, date_from, date_to)
+        query_and_params = average_query(args['origin'], args['destination'], args['date_from'], args['date_to'])
 
-        conn = connect_database()
-        cursor = conn.cursor()
-        cursor.execute(query_and_params['query'], query_and_params['params'])
-        result = cursor.fetchall()
-        cursor.close() # Close database connection
+        result = execute_read_query(query_and_params['query'], query_and_params['params'])
 
         ret = [
             {
@@ -104,6 +95,59 @@ def average():
 
         return jsonify(ret)
 
+@app.route('/api/v1/average_breakdown', methods=['GET'])
+def average_breakdown():
+    """ Return the average daily price of transactions between each child
+    region (or port) of the origin and each child region (or port) of the
+    destination within a date range.
+
+    All pairs are computed in a single grouped query. A code is not broken
+    down further. If a pair's average is comprised of fewer than 3
+    transactions on a day, return null for that day.
+    """
+    args = parse_average_args(request.args)
+
+    if 'error' in args:
+        return args['error']
+
+    else:
+        query_and_params = average_breakdown_query(args['origin'], args['destination'], args['date_from'], args['date_to'])
+
+        result = execute_read_query(query_and_params['query'], query_and_params['params'])
+
+        ret = []
+        for orig_group, dest_group, date, decimal in result:
+            # Rows are ordered by group pair, so start a new entry when the pair changes
+            if not ret or (ret[-1]['origin'], ret[-1]['destination']) != (orig_group, dest_group):
+                ret.append({'origin': orig_group, 'destination': dest_group, 'prices': []})
+
+            ret[-1]['prices'].append({
+                'date': str(date.strftime('%Y-%m-%d'))
+                , 'average_price': None if decimal is None else str(decimal).partition('.')[0]
+            })
+
+        return jsonify(ret)
+
+def parse_average_args(args):
+    """ Return the origin, destination and date range of an average request,
+    or the error response if any of them is missing or invalid.
+    """
+    origin = args.get('origin') # ensure required arguments are passed
+    destination = args.get('destination')
+    date_from = args.get('date_from')
+    date_to = args.get('date_to')
+
+    if is_null_or_empty(origin, destination, date_from, date_to):
+        return {'error': (jsonify( {'error': 'Required parameter is missing or empty'} ), 400)}
+
+    elif not is_valid_date(date_from) or not is_valid_date(date_to):
+        return {'error': (jsonify( {'error': 'Improper date format provided, use YYYY-MM-DD'} ), 400)}
+
+    elif not is_valid_code_or_slug(origin) or not is_valid_code_or_slug(destination):
+        return {'error': jsonify( {'error': 'Non-existent code or slug provided'} )} # still valid input
+
+    return {'origin': origin, 'destination': destination, 'date_from': date_from, 'date_to': date_to}
+
 def average_query(origin, destination, date_from, date_to):
     """ Return the appropriate average query given whether
     {origin, destination} are in code or slug format.
@@ -135,6 +179,47 @@ def average_query(origin, destination, date_from, date_to):
 
     return {'query': query, 'params': params}
 
+def average_breakdown_query(origin, destination, date_from, date_to):
+    """ Return the breakdown query along with each side's port codes and
+    the group each port code is reported under.
+    """
+    config = configparser.ConfigParser()
+    config.read(PROPERTIES_FILE)
+
+    query = resource_string(__name__, config.get('queries', 'get_average_breakdown'))
+
+    orig_groups = get_breakdown_groups(origin)
+    dest_groups = get_breakdown_groups(destination)
+
+    params = {
+        'orig_codes': list(orig_groups.keys())
+        , 'orig_groups': list(orig_groups.values())
+        , 'dest_codes': list(dest_groups.keys())
+        , 'dest_groups': list(dest_groups.values())
+        , 'date_from': date_from
+        , 'date_to': date_to
+    }
+
+    return {'query': query, 'params': params}
+
+def get_breakdown_groups(location):
+    """ Map each port under a location to the group it is reported under.
+    Ports under a direct subslug (or its descendants) are grouped by that
+    subslug; ports directly under the slug are reported individually.
+    """
+    if is_code(location):
+        return {location: location}
+
+    groups = {}
+    for subslug in cache_direct_subslugs[location]:
+        for code in get_ports_of_slug_and_descendants(subslug):
+            groups[code] = subslug
+
+    for code in cache_port_codes[location]:
+        groups[code] = code
+
+    return groups
+
 def get_ports_of_slug_and_descendants(slug):
     """ Return all ports associated with a given slug or any of its
     descendant subslugs.
@@ -160,15 +245,225 @@ def connect_database():
     config = configparser.ConfigParser()
     config.read(PROPERTIES_FILE)
 
-    conn = psycopg2.connect(
-        host=config.get('database', 'host')
-        , database=config.get('database', 'database')
-        , user=config.get('database', 'user')
-        , password=config.get('database', 'password')
-        , port=config.get('database', 'port')
-    )
+    conn = psycopg2.connect(**connection_settings(config, 'database'))
     return conn
 
+def connection_settings(config, section):
+    """ Return psycopg2 connection arguments from a section of the
+    properties file, e.g. [database] or a replica's section.
+    """
+    return {
+        'host': config.get(section, 'host')
+        , 'database': config.get(section, 'database')
+        , 'user': config.get(section, 'user')
+        , 'password': config.get(section, 'password')
+        , 'port': config.get(section, 'port')
+    }
+
+def execute_read_query(query, params=None):
+    """ Run a read-only query and return all rows.
+
+    Replicas listed under [replicas] in the properties file are tried in
+    round-robin order. A replica that cannot be reached, or whose replication
+    lag exceeds max_replication_lag, is skipped until the background health
+    check finds it usable again. If no replica is usable, the query is sent
+    to the primary [database].
+    """
+    for name in replicas_in_round_robin_order():
+        state = replicas[name]
+        if not is_replica_usable(state):
+            continue
+
+        pool = state['pool']
+        try:
+            conn = pool.getconn()
+        except PoolError: # replica is busy, not unhealthy
+            continue
+        except psycopg2.Error:
+            mark_replica_unhealthy(name)
+            continue
+
+        try:
+            result = run_query(conn, query, params)
+        except psycopg2.OperationalError: # replica went away mid-query
+            pool.putconn(conn, close=True)
+            mark_replica_unhealthy(name)
+            continue
+        except psycopg2.Error:
+            pool.putconn(conn, close=True)
+            raise
+
+        try:
+            conn.rollback() # end the read transaction before returning to the pool
+        except psycopg2.Error: # replica went away after the rows were read
+            pool.putconn(conn, close=True)
+            mark_replica_unhealthy(name)
+        else:
+            pool.putconn(conn)
+
+        return result
+
+    conn = connect_database()
+    try:
+        return run_query(conn, query, params)
+    finally:
+        conn.close() # Close database connection
+
+def run_query(conn, query, params=None):
+    cursor = conn.cursor()
+    cursor.execute(query, params)
+    result = cursor.fetchall()
+    cursor.close()
+
+    return result
+
+def replicas_in_round_robin_order():
+    """ Return the names of all replicas, starting from the next replica in
+    round-robin order.
+    """
+    load_replicas()
+
+    names = sorted(replicas)
+    if not names:
+        return []
+
+    with replica_lock:
+        start = next(replica_counter) % len(names)
+
+    return names[start:] + names[:start]
+
+def load_replicas():
+    """ Register each replica listed under [replicas] once and start
+    checking their health in the background. Replicas are not used until
+    their first check passes, so a down replica does not prevent the API
+    from starting.
+
+    Invalid replica settings raise here rather than in the background.
+    """
+    global replicas_loaded, replica_config, replica_settings
+
+    with replica_lock:
+        if replicas_loaded:
+            return
+
+        config = configparser.ConfigParser()
+        config.read(PROPERTIES_FILE)
+
+        settings = read_replica_settings(config)
+        names = replica_names(config)
+        for name in names:
+            connection_settings(config, name) # raises if the section is missing or incomplete
+
+        for name in names:
+            replicas[name] = {'pool': None, 'check_conn': None, 'healthy': False, 'lag': None, 'checked_at': 0.0}
+        replica_config = config
+        replica_settings = settings
+        replicas_loaded = True
+
+    if replicas:
+        threading.Thread(target=check_replicas_periodically, daemon=True).start()
+
+def replica_names(config):
+    names = config.get('replicas', 'names', fallback='')
+    return [name.strip() for name in names.split(',') if name.strip()]
+
+def read_replica_settings(config):
+    """ Parse the [replicas] settings, raising ValueError for a setting that
+    is not a number.
+    """
+    max_lag = config.get('replicas', 'max_replication_lag', fallback='')
+
+    return {
+        'max_replication_lag': None if max_lag == '' else float(max_lag)
+        , 'health_check_interval': config.getfloat('replicas', 'health_check_interval', fallback=10)
+        , 'connect_timeout': config.getint('replicas', 'connect_timeout', fallback=2)
+        , 'min_connections': config.getint('replicas', 'min_connections', fallback=1)
+        , 'max_connections': config.getint('replicas', 'max_connections', fallback=10)
+    }
+
+def is_replica_usable(state):
+    """ Check the replica passed its last health check and, if
+    max_replication_lag is set, that the lag it measured plus the time since
+    then is still within the bound.
+    """
+    if not state['healthy']:
+        return False
+
+    max_lag = replica_settings.get('max_replication_lag')
+    if max_lag is None:
+        return True
+
+    return state['lag'] + (time.time() - state['checked_at']) <= max_lag
+
+def check_replicas_periodically():
+    """ Re-check every replica each health_check_interval seconds.
+    This is the only thread that probes replicas, so requests never wait on
+    a health check.
+    """
+    while True:
+        for name in sorted(replicas):
+            try:
+                check_replica(name, replica_config)
+            except Exception: # keep checking the other replicas
+                app.logger.exception('Health check of replica %s failed', name)
+                mark_replica_unhealthy(name)
+
+        time.sleep(replica_settings['health_check_interval'])
+
+def check_replica(name, config):
+    """ Verify the replica accepts connections and, if max_replication_lag
+    is set, that it is no further behind the primary than that many seconds.
+    Records the result in the replica's state and returns whether it is healthy.
+
+    The check uses its own connection so it still runs when requests hold
+    every connection in the replica's pool.
+    """
+    settings = read_replica_settings(config)
+    state = replicas[name]
+    healthy = False
+    lag = None
+
+    try:
+        if state['pool'] is None:
+            # Connect outside the lock so a slow replica does not block requests
+            pool = ThreadedConnectionPool(
+                settings['min_connections']
+                , settings['max_connections']
+                , connect_timeout=settings['connect_timeout']
+                , **connection_settings(config, name)
+            )
+            with replica_lock:
+                state['pool'] = pool
+
+        if state['check_conn'] is None:
+            state['check_conn'] = psycopg2.connect(
+                connect_timeout=settings['connect_timeout']
+                , **connection_settings(config, name)
+            )
+
+        lag = run_query(state['check_conn'], resource_string(__name__, config.get('queries', 'replication_lag')))[0][0]
+        state['check_conn'].rollback()
+
+        lag = None if lag is None else float(lag) # None: lag is unknown
+        max_lag = settings['max_replication_lag']
+        healthy = max_lag is None or (lag is not None and lag <= max_lag)
+
+    except psycopg2.Error:
+        if state['check_conn'] is not None:
+            state['check_conn'].close()
+            state['check_conn'] = None
+
+    with replica_lock:
+        state['healthy'] = healthy
+        state['lag'] = lag
+        state['checked_at'] = time.time()
+
+    return healthy
+
+def mark_replica_unhealthy(name):
+    with replica_lock:
+        replicas[name]['healthy'] = False
+
 def is_valid_code_or_slug(location):
     """ Check that the code or slug exists in the database.
     """
@@ -180,13 +475,9 @@ def is_valid_code_or_slug(location):
     else:
         query = resource_string(__name__, config.get('queries', 'verify_slug'))
 
-    conn = connect_database()
-    cursor = conn.cursor()
-    cursor.execute(query, {'location': location})
-    result = cursor.fetchone()
-    cursor.close() # Close database connection
+    result = execute_read_query(query, {'location': location})
 
-    return result[0] # True or False
+    return result[0][0] # True or False
 
 def is_code(location):
     return len(location) == 5 and location.isupper()
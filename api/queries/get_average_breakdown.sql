@@ -0,0 +1,21 @@
+-- Average price for each (origin group, destination group) pair and day in date range
+-- for each day where at least 3 transactions took place within that pair
+-- API maps every port code to its group (a child region, or the port itself)
+WITH orig_groups AS (
+	SELECT code, grp
+	FROM unnest(%(orig_codes)s::text[], %(orig_groups)s::text[]) AS g(code, grp)
+), dest_groups AS (
+	SELECT code, grp
+	FROM unnest(%(dest_codes)s::text[], %(dest_groups)s::text[]) AS g(code, grp)
+)
+SELECT orig_groups.grp AS origin, dest_groups.grp AS destination, prices.day,
+	CASE WHEN COUNT(*) >= 3 THEN AVG(prices.price)
+		ELSE null
+	END AS average
+FROM prices
+JOIN orig_groups ON prices.orig_code = orig_groups.code
+JOIN dest_groups ON prices.dest_code = dest_groups.code
+WHERE prices.day BETWEEN %(date_from)s::DATE AND %(date_to)s::DATE
+GROUP BY orig_groups.grp, dest_groups.grp, prices.day
+ORDER BY orig_groups.grp ASC, dest_groups.grp ASC, prices.day ASC
+;
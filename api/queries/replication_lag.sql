@@ -0,0 +1,13 @@
+-- Seconds the server is behind the primary
+-- (0 on the primary itself or when a streaming replica has replayed everything it received,
+-- null when a replica is not streaming from the primary and so cannot know how far behind it is)
+SELECT CASE
+	WHEN NOT pg_is_in_recovery() THEN 0
+	WHEN NOT EXISTS (
+		SELECT 1
+		FROM pg_stat_wal_receiver
+		WHERE status = 'streaming'
+	) THEN null
+	WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+	ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END AS lag_seconds
@@ -1,5 +1,13 @@
 import requests
 
+import configparser
+import time
+import pytest
+import psycopg2
+from psycopg2.pool import PoolError
+
+import api
+
 url = 'http://127.0.0.1:5000/api/v1/average'
 params = '?origin={}&destination={}&date_from={}&date_to={}'
 
@@ -341,6 +349,76 @@ def test_china_north_main_to_uk_main():
         ;
     """
 
+################################################################################
+#
+# Breakdown by child region (or port)
+#
+################################################################################
+
+breakdown_url = 'http://127.0.0.1:5000/api/v1/average_breakdown'
+
+def breakdown_day(body, origin, destination, date):
+    """ Return the pair's entry for a date, or None if it was not returned.
+    """
+    for pair in body:
+        if pair['origin'] == origin and pair['destination'] == destination:
+            for day in pair['prices']:
+                if day['date'] == date:
+                    return day
+
+# Check averages for each (origin child, destination child) pair
+def test_china_main_to_baltic_breakdown():
+    request = breakdown_url + params.format('china_main', 'baltic', '2016-01-01', '2016-01-31')
+    response = requests.get(request)
+    body = response.json()
+
+    # Subslugs of china_main and baltic are grouped, ports directly under baltic are not
+    origins = {pair['origin'] for pair in body}
+    destinations = {pair['destination'] for pair in body}
+    assert origins == {'china_east_main', 'china_south_main', 'china_north_main'}
+    assert {'finland_main', 'baltic_main', 'poland_main', 'FITKU', 'RULED'} <= destinations
+
+    # 2016-01-01
+    average = int(breakdown_day(body, 'china_south_main', 'baltic_main', '2016-01-01')['average_price'])
+    assert average == 1158
+
+    # 2016-01-31
+    average = int(breakdown_day(body, 'china_east_main', 'finland_main', '2016-01-31')['average_price'])
+    assert average == 966
+
+    '''
+    Verify manually:
+    '''
+    query = """
+        SELECT AVG(price)
+        FROM prices
+        WHERE orig_code IN (
+            SELECT code
+            FROM ports
+            WHERE parent_slug = 'china_east_main'
+        )
+        AND dest_code IN (
+            SELECT code
+            FROM ports
+            WHERE parent_slug = 'finland_main'
+        )
+        AND day = '2016-01-31'::DATE
+        ;
+    """
+
+    # 2016-01-01: fewer than 3 transactions between china_north_main and FITKU
+    day = breakdown_day(body, 'china_north_main', 'FITKU', '2016-01-01')
+    assert day is not None
+    assert day['average_price'] is None
+
+# Edge case: slug does not exist
+def test_china_main_to_scandinavialand_breakdown():
+    request = breakdown_url + params.format('china_main', 'scandinavialand', '2016-01-01', '2016-01-31')
+    response = requests.get(request)
+    body = response.json()
+
+    assert body['error'] == 'Non-existent code or slug provided'
+
 ################################################################################
 #
 # Edge cases
@@ -471,4 +549,210 @@ def test_uk_sub_to_uk_sub():
         )
         ORDER BY day, orig_code
         ;
-    """
\ No newline at end of file
+    """
+
+################################################################################
+#
+# Read replica routing
+#
+# These call api.py directly with fake pools in place of replicas,
+# except test_unreachable_replica which uses a real (closed) port.
+#
+################################################################################
+
+class FakeConnection:
+    def __init__(self, name, rollback_error=None):
+        self.name = name
+        self.rollback_error = rollback_error
+
+    def rollback(self):
+        if self.rollback_error is not None:
+            raise self.rollback_error
+
+    def close(self):
+        pass
+
+class FakePool:
+    def __init__(self, name, error=None, rollback_error=None):
+        self.name = name
+        self.error = error
+        self.rollback_error = rollback_error
+        self.closed = []
+
+    def getconn(self):
+        if self.error is not None:
+            raise self.error
+        return FakeConnection(self.name, self.rollback_error)
+
+    def putconn(self, conn, close=False):
+        self.closed.append(close)
+
+def replica_state(pool=None, healthy=True, lag=0.0, checked_at=None):
+    return {
+        'pool': pool
+        , 'check_conn': None if pool is None else FakeConnection(pool.name)
+        , 'healthy': healthy
+        , 'lag': lag
+        , 'checked_at': time.time() if checked_at is None else checked_at
+    }
+
+def use_replicas(monkeypatch, pools, healthy=True, max_replication_lag=None):
+    """ Replace the configured replicas with fake pools. Each query returns
+    the name of the server it ran on.
+    """
+    monkeypatch.setattr(api, 'replicas', {
+        name: replica_state(pool, healthy) for name, pool in pools.items()
+    })
+    monkeypatch.setattr(api, 'replicas_loaded', True)
+    monkeypatch.setattr(api, 'replica_settings', {'max_replication_lag': max_replication_lag})
+    monkeypatch.setattr(api, 'run_query', lambda conn, query, params=None: conn.name)
+    monkeypatch.setattr(api, 'connect_database', lambda: FakeConnection('database'))
+
+def replica_config(**settings):
+    config = configparser.ConfigParser()
+    config.read(api.PROPERTIES_FILE)
+    config.read_dict({'replicas': settings})
+    return config
+
+# Reads alternate between healthy replicas
+def test_replicas_round_robin(monkeypatch):
+    use_replicas(monkeypatch, {'replica_1': FakePool('replica_1'), 'replica_2': FakePool('replica_2')})
+
+    servers = [api.execute_read_query('SELECT 1') for _ in range(4)]
+
+    assert set(servers) == {'replica_1', 'replica_2'}
+    assert servers[0] != servers[1] and servers[1] != servers[2]
+
+# Reads skip a replica that cannot be reached, and it is marked unhealthy
+def test_replicas_skip_down_replica(monkeypatch):
+    use_replicas(monkeypatch, {
+        'replica_1': FakePool('replica_1', psycopg2.OperationalError())
+        , 'replica_2': FakePool('replica_2')
+    })
+
+    servers = [api.execute_read_query('SELECT 1') for _ in range(4)]
+
+    assert set(servers) == {'replica_2'}
+    assert api.replicas['replica_1']['healthy'] is False
+
+# Reads skip a replica whose pool is exhausted, but it stays healthy
+def test_replicas_skip_busy_replica(monkeypatch):
+    use_replicas(monkeypatch, {
+        'replica_1': FakePool('replica_1', PoolError())
+        , 'replica_2': FakePool('replica_2')
+    })
+
+    servers = [api.execute_read_query('SELECT 1') for _ in range(4)]
+
+    assert set(servers) == {'replica_2'}
+    assert api.replicas['replica_1']['healthy'] is True
+
+# A health check still passes while requests hold every connection in the pool
+def test_replicas_check_busy_replica(monkeypatch):
+    monkeypatch.setattr(api, 'replicas', {'replica_1': replica_state(FakePool('replica_1', PoolError()))})
+    monkeypatch.setattr(api, 'run_query', lambda conn, query, params=None: [(0,)])
+
+    assert api.check_replica('replica_1', replica_config(max_replication_lag='5')) is True
+    assert api.replicas['replica_1']['healthy'] is True
+
+# Rows already read are returned if the replica drops before the rollback
+def test_replicas_rollback_fails(monkeypatch):
+    pool = FakePool('replica_1', rollback_error=psycopg2.OperationalError())
+    use_replicas(monkeypatch, {'replica_1': pool})
+
+    assert api.execute_read_query('SELECT 1') == 'replica_1'
+    assert pool.closed == [True] # connection discarded, not returned to the pool
+    assert api.replicas['replica_1']['healthy'] is False
+
+# Reads go to [database] when no replica is usable
+def test_replicas_fall_back_to_database(monkeypatch):
+    use_replicas(monkeypatch, {'replica_1': FakePool('replica_1')}, healthy=False)
+
+    assert api.execute_read_query('SELECT 1') == 'database'
+
+# A replica further behind than max_replication_lag, or of unknown lag, fails its check
+def test_replicas_lag_threshold(monkeypatch):
+    monkeypatch.setattr(api, 'replicas', {'replica_1': replica_state(FakePool('replica_1'), healthy=False)})
+    config = replica_config(max_replication_lag='5')
+
+    monkeypatch.setattr(api, 'run_query', lambda conn, query, params=None: [(1,)])
+    assert api.check_replica('replica_1', config) is True
+
+    monkeypatch.setattr(api, 'run_query', lambda conn, query, params=None: [(10,)])
+    assert api.check_replica('replica_1', config) is False
+
+    monkeypatch.setattr(api, 'run_query', lambda conn, query, params=None: [(None,)])
+    assert api.check_replica('replica_1', config) is False
+
+    # No bound configured: lag is not considered
+    config = replica_config(max_replication_lag='')
+    assert api.check_replica('replica_1', config) is True
+
+# Time since the last check counts towards max_replication_lag
+def test_replicas_lag_since_check(monkeypatch):
+    use_replicas(monkeypatch, {'replica_1': FakePool('replica_1')}, max_replication_lag=5)
+
+    api.replicas['replica_1'].update(lag=4.0, checked_at=time.time())
+    assert api.execute_read_query('SELECT 1') == 'replica_1'
+
+    api.replicas['replica_1'].update(lag=4.0, checked_at=time.time() - 2)
+    assert api.execute_read_query('SELECT 1') == 'database'
+
+# Edge case: invalid replica settings fail when replicas are loaded
+def test_replicas_invalid_config(monkeypatch, tmp_path):
+    monkeypatch.setattr(api, 'replicas', {})
+    monkeypatch.setattr(api, 'replicas_loaded', False)
+
+    properties = tmp_path / 'api.properties'
+    monkeypatch.setattr(api, 'PROPERTIES_FILE', str(properties))
+
+    properties.write_text('[replicas]\nnames = replica_1\n') # no [replica_1] section
+    with pytest.raises(configparser.NoSectionError):
+        api.load_replicas()
+
+    properties.write_text('[replicas]\nmax_replication_lag = soon\n')
+    with pytest.raises(ValueError):
+        api.load_replicas()
+
+    assert api.replicas_loaded is False
+
+# Edge case: an unexpected error checking one replica does not stop checks of the others
+def test_replicas_check_error(monkeypatch):
+    use_replicas(monkeypatch, {'replica_1': FakePool('replica_1'), 'replica_2': FakePool('replica_2')})
+    monkeypatch.setattr(api, 'replica_settings', {'health_check_interval': 10})
+
+    checked = []
+    def check_replica(name, config):
+        checked.append(name)
+        if name == 'replica_1':
+            raise KeyError(name)
+        return True
+
+    class StopChecking(Exception):
+        pass
+
+    def sleep(seconds):
+        raise StopChecking
+
+    monkeypatch.setattr(api, 'check_replica', check_replica)
+    monkeypatch.setattr(api.time, 'sleep', sleep)
+
+    with pytest.raises(StopChecking):
+        api.check_replicas_periodically()
+
+    assert checked == ['replica_1', 'replica_2']
+    assert api.replicas['replica_1']['healthy'] is False
+
+# Edge case: configured replica is unreachable, reads still succeed against [database]
+def test_unreachable_replica(monkeypatch):
+    monkeypatch.setattr(api, 'replicas', {'replica_1': replica_state(healthy=False, checked_at=0.0)})
+    monkeypatch.setattr(api, 'replicas_loaded', True)
+
+    config = replica_config(connect_timeout='1')
+    config.read_dict({'replica_1': {
+        'host': '127.0.0.1', 'database': 'postgres', 'user': 'postgres'
+        , 'password': 'ratestask', 'port': '1' # nothing listens on port 1
+    }})
+
+    assert api.check_replica('replica_1', config) is False
+    assert api.is_valid_code_or_slug('baltic') is True